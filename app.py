@@ -1,107 +1,102 @@
+import asyncio
 import streamlit as st
-import openai
-from fpdf import FPDF
-import base64
-from gtts import gTTS
-import os
-
-# Function to set the OpenAI API key
-def set_openai_key():
-    st.sidebar.write("🔑 **Enter your OpenAI API Key**")
-    api_key = st.sidebar.text_input("API Key", type="password")
-    if api_key:
-        openai.api_key = api_key
-        st.session_state.api_key = api_key
-        st.sidebar.success("API Key set successfully!")
-
-# Define the prompt template for story generation with theme
-def get_prompt_for_theme(base_story, choice, theme):
-    # Add the theme into the prompt
-    theme_based_prompt = f"Generate a story with the theme of {theme}.\n\n"
-    theme_based_prompt += f"The story starts with: {base_story}\n"
-    theme_based_prompt += f"The user makes a choice: {choice}\n"
-    theme_based_prompt += "Continue the story based on the theme and choice."
-
-    return theme_based_prompt
-
-def generate_story(base_story, choice, theme):
-    prompt = get_prompt_for_theme(base_story, choice, theme)
-
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=900,
-        temperature=0.7,
+from story_utils import (
+    AUTO_CONTINUATIONS, BRANCH_TEMPERATURES,
+    set_openai_key, run_async, generate_stories, stream_story_text,
+    init_story_state, reset_story, get_story_context, update_running_summary,
+    add_story_part, show_export_options,
+)
+
+# Story themes offered in the sidebar
+THEME_OPTIONS = ["Adventure", "Romance", "Mystery", "Sci-Fi", "Fantasy"]
+
+# Define the prompt templates for story generation with theme.
+# The theme is the same for the whole story, so it goes into the system message and only
+# the user message changes from turn to turn.
+system_prompt_template = "You are a helpful assistant. Generate a story with the theme of {theme}."
+
+prompt_template = """The story starts with: {start}
+The user makes a choice: {choice}
+Continue the story based on the theme and choice."""
+
+# Function to build the chat messages for a story request
+def get_story_messages(base_story, choice, theme):
+    system_prompt = system_prompt_template.format(theme=theme)
+    prompt = prompt_template.format(start=base_story, choice=choice)
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+
+# Function to continue the story from the bounded context, refreshing the running summary concurrently
+async def continue_story(client, choice, theme, n=1):
+    new_stories, _ = await asyncio.gather(
+        generate_stories(client, get_story_messages(get_story_context(), choice, theme), n=n),
+        update_running_summary(client),
     )
-    
-    story = response['choices'][0]['message']['content'].strip()
-    return story
-
-def convert_to_pdf(story_parts):
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.set_font("Arial", size=12)
-
-    for part in story_parts:
-        pdf.multi_cell(0, 10, part)
-
-    return pdf
+    return new_stories
+
+# Function to continue the story with the user's choice, streaming the new part into a
+# placeholder as it is written
+async def continue_story_into_slot(client, choice, theme, text_slot):
+    new_story, _ = await asyncio.gather(
+        stream_story_text(client, get_story_messages(get_story_context(), choice, theme), text_slot),
+        update_running_summary(client),
+    )
+    add_story_part(new_story)
+    text_slot.markdown(new_story)
 
-def convert_to_audio(story, language='en'):
-    tts = gTTS(text=story, lang=language, slow=False)
-    audio_file = "story_audio.mp3"
-    tts.save(audio_file)
-    return audio_file
+# Function to explore several branches of the story at once, one concurrent request per temperature
+async def generate_branches(client, choice, theme):
+    messages = get_story_messages(get_story_context(), choice, theme)
+    branches = await asyncio.gather(*[generate_stories(client, messages, temperature=t) for t in BRANCH_TEMPERATURES])
+    return [stories[0] for stories in branches]
 
 def main():
     st.title("🌟 Interactive Storytelling App")
 
     # Set OpenAI API key from user input
-    set_openai_key()
+    client = set_openai_key()
     
-    if not st.session_state.get("api_key"):
+    if client is None:
         st.warning("Please enter your OpenAI API key in the sidebar to start.")
         return
 
-    if "story" not in st.session_state:
-        st.session_state.story = []
-        st.session_state.started = False
-        st.session_state.stopped = False
+    init_story_state()
 
     with st.sidebar:
         st.header("Story Settings")
         
         # Add a dropdown to choose the story theme
-        theme = st.selectbox("Choose a Story Theme", ["Adventure", "Romance", "Mystery", "Sci-Fi", "Fantasy"])
+        theme = st.selectbox("Choose a Story Theme", THEME_OPTIONS)
         
         base_story = st.text_area("📝 Base Story Idea", height=150, help="Enter the idea that will kickstart your story.")
         if st.button("🎬 Start Story"):
             if base_story.strip():
-                st.session_state.story = [base_story]
-                st.session_state.started = True
-                st.session_state.stopped = False
+                reset_story(base_story)
                 st.session_state.theme = theme
                 st.success("Story started successfully!")
             else:
                 st.error("Please enter a base story idea to start.")
     
     if st.session_state.get("started", False):
+        # Message left by an action that reran the page to show its result
+        if "success_message" in st.session_state:
+            st.success(st.session_state.pop("success_message"))
+
         st.subheader("📖 Your Story So Far")
-        st.markdown(" ".join(st.session_state.story))
+        st.markdown(st.session_state.story_text)
         
         if not st.session_state.stopped:
-            user_choice = st.text_input("🤔 What happens next?", placeholder="Enter a decision or action...")
-            col1, col2, col3 = st.columns([2, 2, 1])
+            # Surrounding whitespace is dropped so a blank choice never reaches the model
+            user_choice = st.text_input("🤔 What happens next?", placeholder="Enter a decision or action...").strip()
+            col1, col2, col3, col4 = st.columns([2, 2, 2, 1])
             
             with col1:
                 if st.button("Continue Story"):
                     if user_choice:
-                        new_story = generate_story(" ".join(st.session_state.story), user_choice, st.session_state.theme)
-                        st.session_state.story.append(new_story)
+                        text_slot = st.empty()
+                        run_async(continue_story_into_slot(client, user_choice, st.session_state.theme, text_slot))
                         st.success("Story continued!")
                     else:
                         st.warning("Please enter a choice to continue the story.")
@@ -109,35 +104,45 @@ def main():
             with col2:
                 if st.button("Continue Automatically"):
                     last_part = st.session_state.story[-1] if st.session_state.story else ""
-                    new_story = generate_story(" ".join(st.session_state.story), last_part, st.session_state.theme)
-                    st.session_state.story.append(new_story)
-                    st.success("Story continued automatically!")
+                    # A single request returns several continuations to choose from
+                    st.session_state.candidates = run_async(continue_story(client, last_part, st.session_state.theme, n=AUTO_CONTINUATIONS))
             
             with col3:
+                if st.button("Generate Branches"):
+                    # Explore the user's choice, or let the story run on by itself when there is none
+                    last_part = st.session_state.story[-1] if st.session_state.story else ""
+                    st.session_state.branches = run_async(generate_branches(client, user_choice or last_part, st.session_state.theme))
+
+            with col4:
                 if st.button("⛔ Stop Story"):
                     st.session_state.stopped = True
                     st.info("Story stopped. You can now convert it to PDF or Audio.")
 
+            # Let the user pick one of the automatic continuations
+            if st.session_state.candidates:
+                candidates = st.session_state.candidates
+                for i, candidate in enumerate(candidates, start=1):
+                    st.markdown(f"**Option {i}:** {candidate}")
+                picked = st.radio("✨ Pick a continuation", range(len(candidates)), format_func=lambda i: f"Option {i + 1}", horizontal=True)
+                if st.button("✅ Use This Continuation"):
+                    add_story_part(candidates[picked])
+                    # Rerun so the story above shows the new part and the options go away
+                    st.session_state.success_message = "Story continued automatically!"
+                    st.rerun()
+
+            # Show the branches side by side; picking one appends it to the story
+            if st.session_state.branches:
+                branch_cols = st.columns(len(st.session_state.branches))
+                for i, (branch_col, branch) in enumerate(zip(branch_cols, st.session_state.branches), start=1):
+                    with branch_col:
+                        st.markdown(branch)
+                        if st.button(f"Use Branch {i}"):
+                            add_story_part(branch)
+                            st.session_state.success_message = "Story continued!"
+                            st.rerun()
+
         if st.session_state.stopped:
-            st.subheader("📤 Export Your Story")
-            
-            if st.button("🖨️ Convert to PDF"):
-                pdf = convert_to_pdf(st.session_state.story)
-                pdf_output = pdf.output(dest='S').encode('latin1')
-                b64_pdf = base64.b64encode(pdf_output).decode('latin1')
-                href = f'<a href="data:application/octet-stream;base64,{b64_pdf}" download="story.pdf">Download PDF</a>'
-                st.markdown(href, unsafe_allow_html=True)
-
-            language_option = st.selectbox("🌍 Choose a language for the audio:", ["English", "Spanish", "French", "Chinese"])
-            lang_dict = {"English": "en", "Spanish": "es", "French": "fr", "Chinese": "zh"}
-
-            if st.button("🎧 Convert to Audio"):
-                selected_lang = lang_dict[language_option]
-                audio_file = convert_to_audio(" ".join(st.session_state.story), language=selected_lang)
-                with open(audio_file, "rb") as audio:
-                    b64_audio = base64.b64encode(audio.read()).decode('latin1')
-                href = f'<a href="data:audio/mp3;base64,{b64_audio}" download="story_audio.mp3">Download Audio</a>'
-                st.markdown(href, unsafe_allow_html=True)
+            show_export_options()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,27 +1,25 @@
-import openai
+import asyncio
 import streamlit as st
-from fpdf import FPDF
-import base64
-from gtts import gTTS
-import os
-from PIL import Image
-import io
-
-# Function to set the OpenAI API key
-def set_openai_key():
-    st.sidebar.write("🔑 **Enter your OpenAI API Key**")
-    api_key = st.sidebar.text_input("API Key", type="password")
-    if api_key:
-        openai.api_key = api_key
-        st.session_state.api_key = api_key
-        st.sidebar.success("API Key set successfully!")
-
-# Function to add multiple characters
+from openai import OpenAIError
+from story_utils import (
+    AUTO_CONTINUATIONS, BRANCH_TEMPERATURES,
+    set_openai_key, run_async, generate_stories, stream_story_text, summarize_text,
+    init_story_state, reset_story, get_story_context, update_running_summary,
+    add_story_part, show_export_options,
+)
+
+# Story themes offered in the sidebar
+THEME_OPTIONS = ["Fantasy", "Mystery", "Adventure", "Sci-Fi", "Horror", "Romance"]
+
+# Token budget of the image prompt, which DALL·E caps at 1000 characters
+IMAGE_PROMPT_TOKENS = 150
+
 def add_multiple_characters():
     st.sidebar.header("👤 Add Characters (Max 10)")
     
     if "characters" not in st.session_state:
         st.session_state.characters = []
+        st.session_state.characters_description = ""
 
     # Allow user to add a new character until there are 10 characters
     if len(st.session_state.characters) < 10:
@@ -35,6 +33,8 @@ def add_multiple_characters():
             if name:
                 character = {"name": name, "personality": personality, "appearance": appearance}
                 st.session_state.characters.append(character)
+                # Format the prompt description once here rather than on every story request
+                st.session_state.characters_description = format_characters(st.session_state.characters)
                 st.success(f"Character {name} added!")
             else:
                 st.warning("Please enter a character name.")
@@ -53,87 +53,116 @@ The user makes a choice: {choice}
 Based on this choice, continue the story in a creative way:
 """
 
-# Function to generate the story
-def generate_story_with_characters(characters, theme, prompt, choice):
-    # Adding the characters to the prompt
-    characters_description = ""
-    for character in characters:
-        characters_description += f"Your character is {character['name']}, who is {character['personality']} and has {character['appearance']}.\n"
-    
-    formatted_prompt = f"Theme: {theme}. {characters_description} {prompt_template.format(start=prompt, choice=choice)}"
-
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": formatted_prompt}
-        ],
-        max_tokens=900,
-        temperature=0.7,
+# The theme and characters are the same for the whole story, so they go into the system
+# message and only the user message changes from turn to turn.
+system_prompt_template = "You are a helpful assistant. Theme: {theme}. {characters}"
+
+# Function to describe the characters for the prompt, one line per character
+def format_characters(characters):
+    return "".join(
+        f"Your character is {character['name']}, who is {character['personality']} and has {character['appearance']}.\n"
+        for character in characters
     )
 
-    story = response['choices'][0]['message']['content'].strip()
-    return story
+# Function to build the chat messages for a story request
+def get_story_messages(characters_description, theme, prompt, choice):
+    # Adding the characters to the prompt
+    system_prompt = system_prompt_template.format(theme=theme, characters=characters_description)
+    formatted_prompt = prompt_template.format(start=prompt, choice=choice)
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": formatted_prompt}
+    ]
 
-# Function to summarize the prompt to reduce token count
-def summarize_text(text):
-    summarization_prompt = f"Please summarize the following text to stay under 800 tokens while maintaining its main idea:\n\n{text}"
-    
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": summarization_prompt}
-        ],
-        max_tokens=300,
-        temperature=0.7,
-    )
-    
-    summarized_text = response['choices'][0]['message']['content'].strip()
-    return summarized_text
+# Function to generate the story
+async def generate_story_with_characters(client, characters_description, theme, prompt, choice, n=1, temperature=0.7):
+    return await generate_stories(client, get_story_messages(characters_description, theme, prompt, choice), n=n, temperature=temperature)
+
+# Function to stream a single story part into a placeholder as the tokens arrive
+async def stream_story_with_characters(client, characters_description, theme, prompt, choice, text_slot, temperature=0.7):
+    return await stream_story_text(client, get_story_messages(characters_description, theme, prompt, choice), text_slot, temperature=temperature)
 
 # Function to generate an image using OpenAI's DALL·E
-def generate_image_from_story(story_text):
+async def generate_image_from_story(client, story_text):
     # Summarize the story before passing it to DALL·E
-    summarized_story = summarize_text(story_text)
+    summarized_story = await summarize_text(client, story_text, max_tokens=IMAGE_PROMPT_TOKENS)
     
     # Use DALL·E to generate an image based on the summarized story
-    response = openai.Image.create(
+    response = await client.images.generate(
         prompt=summarized_story,
         n=1,
         size="1024x1024"
     )
     
-    image_url = response['data'][0]['url']
+    image_url = response.data[0].url
     return image_url
 
-# Function to convert story to PDF
-def convert_to_pdf(story_parts):
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.set_font("Arial", size=12)
+# Function to continue the story and illustrate it concurrently.
+# The image only needs the story committed so far, so its summary and DALL·E
+# call run alongside the story request instead of after it, as does the
+# periodic refresh of the running summary. Both work from the bounded context
+# so neither prompt grows with the length of the story.
+async def continue_story_with_image(client, characters_description, theme, choice, n=1):
+    context = get_story_context()
+    image_task = asyncio.create_task(generate_image_from_story(client, context))
+    try:
+        new_stories, _ = await asyncio.gather(
+            generate_story_with_characters(client, characters_description, theme, context, choice, n=n),
+            update_running_summary(client),
+        )
+        image_url = await wait_for_image(image_task)
+    finally:
+        if not image_task.done():
+            image_task.cancel()
+    return new_stories, image_url
+
+# Function to wait for the image of a turn. The picture is optional, so a failed or
+# rejected DALL·E request gives None instead of throwing away the story text
+async def wait_for_image(image_task):
+    try:
+        return await image_task
+    except OpenAIError:
+        return None
 
-    for part in story_parts:
-        pdf.multi_cell(0, 10, part)
+# Function to explore several branches of the story at once, one concurrent request per temperature
+async def generate_branches(client, characters_description, theme, choice):
+    context = get_story_context()
+    branches = await asyncio.gather(*[generate_story_with_characters(client, characters_description, theme, context, choice, temperature=t) for t in BRANCH_TEMPERATURES])
+    return [stories[0] for stories in branches]
 
-    return pdf
+# Function to continue the story with the user's choice, streaming the new part as it is
+# written and showing the image once DALL·E finishes, instead of waiting for both
+async def continue_story_into_slots(client, characters_description, theme, choice, text_slot, image_slot):
+    context = get_story_context()
+    image_task = asyncio.create_task(generate_image_from_story(client, context))
+    try:
+        new_story, _ = await asyncio.gather(
+            stream_story_with_characters(client, characters_description, theme, context, choice, text_slot),
+            update_running_summary(client),
+        )
+        add_story_part(new_story)
+        text_slot.markdown(new_story)
 
-# Function to convert story to audio
-def convert_to_audio(story, language='en'):
-    tts = gTTS(text=story, lang=language, slow=False)
-    audio_file = "story_audio.mp3"
-    tts.save(audio_file)
-    return audio_file
+        image_url = await wait_for_image(image_task)
+    finally:
+        # Never leave the image request pending on the session loop, where it would
+        # resume during a later run
+        if not image_task.done():
+            image_task.cancel()
+
+    if image_url:
+        image_slot.image(image_url, caption="Story Visual", width="stretch")
+    else:
+        image_slot.warning("Could not create an image for this part of the story.")
 
 # Main function
 def main():
     st.title("🌟 Interactive Storytelling App")
 
     # Set OpenAI API key from user input
-    set_openai_key()
+    client = set_openai_key()
 
-    if not st.session_state.get("api_key"):
+    if client is None:
         st.warning("Please enter your OpenAI API key in the sidebar to start.")
         return
 
@@ -142,84 +171,90 @@ def main():
 
     # Theme selection
     st.sidebar.header("📝 Choose Your Story Theme")
-    theme_options = ["Fantasy", "Mystery", "Adventure", "Sci-Fi", "Horror", "Romance"]
-    selected_theme = st.selectbox("Select Story Theme", theme_options)
+    selected_theme = st.selectbox("Select Story Theme", THEME_OPTIONS)
 
-    if "story" not in st.session_state:
-        st.session_state.story = []
-        st.session_state.started = False
-        st.session_state.stopped = False
+    init_story_state()
 
     with st.sidebar:
         st.header("Story Settings")
         base_story = st.text_area("📝 Base Story Idea", height=150, help="Enter the idea that will kickstart your story.")
         if st.button("🎬 Start Story"):
             if base_story.strip():
-                st.session_state.story = [base_story]
-                st.session_state.started = True
-                st.session_state.stopped = False
+                reset_story(base_story)
                 st.success("Story started successfully!")
             else:
                 st.error("Please enter a base story idea to start.")
     
     if st.session_state.get("started", False):
+        # Message left by an action that reran the page to show its result
+        if "success_message" in st.session_state:
+            st.success(st.session_state.pop("success_message"))
+
         st.subheader("📖 Your Story So Far")
-        st.markdown(" ".join(st.session_state.story))
+        st.markdown(st.session_state.story_text)
         
         if not st.session_state.stopped:
-            user_choice = st.text_input("🤔 What happens next?", placeholder="Enter a decision or action...")
-            col1, col2, col3 = st.columns([2, 2, 1])
+            # Surrounding whitespace is dropped so a blank choice never reaches the model
+            user_choice = st.text_input("🤔 What happens next?", placeholder="Enter a decision or action...").strip()
+            col1, col2, col3, col4 = st.columns([2, 2, 2, 1])
             
             with col1:
                 if st.button("Continue Story"):
                     if user_choice:
-                        new_story = generate_story_with_characters(st.session_state.characters, selected_theme, " ".join(st.session_state.story), user_choice)
-                        st.session_state.story.append(new_story)
+                        # Generate the continuation and an image based on the current story
+                        text_slot = st.empty()
+                        image_slot = st.empty()
+                        run_async(continue_story_into_slots(client, st.session_state.characters_description, selected_theme, user_choice, text_slot, image_slot))
                         st.success("Story continued!")
-                        
-                        # Generate image based on the current story
-                        # Generate image based on the current story
-                        image_url = generate_image_from_story(new_story)
-                        st.image(image_url, caption="Story Visual", use_container_width=True)  # Use 'use_container_width' instead of 'use_column_width'
                     else:
                         st.warning("Please enter a choice to continue the story.")
             
             with col2:
                 if st.button("Continue Automatically"):
                     last_part = st.session_state.story[-1] if st.session_state.story else ""
-                    new_story = generate_story_with_characters(st.session_state.characters, selected_theme, " ".join(st.session_state.story), last_part)
-                    st.session_state.story.append(new_story)
-                    st.success("Story continued automatically!")
-                    
-                    # Generate image based on the current story
-                    image_url = generate_image_from_story(new_story)
-                    st.image(image_url, caption="Story Visual", use_column_width=True)
+                    # A single request returns several continuations to choose from, plus an image of the current story
+                    st.session_state.candidates, st.session_state.candidate_image_url = run_async(continue_story_with_image(client, st.session_state.characters_description, selected_theme, last_part, n=AUTO_CONTINUATIONS))
             
             with col3:
+                if st.button("Generate Branches"):
+                    # Explore the user's choice, or let the story run on by itself when there is none
+                    last_part = st.session_state.story[-1] if st.session_state.story else ""
+                    st.session_state.branches = run_async(generate_branches(client, st.session_state.characters_description, selected_theme, user_choice or last_part))
+
+            with col4:
                 if st.button("⛔ Stop Story"):
                     st.session_state.stopped = True
                     st.info("Story stopped. You can now convert it to PDF or Audio.")
 
+            # Let the user pick one of the automatic continuations
+            if st.session_state.candidates:
+                candidates = st.session_state.candidates
+                if st.session_state.candidate_image_url:
+                    st.image(st.session_state.candidate_image_url, caption="Story Visual", width="stretch")
+                else:
+                    st.warning("Could not create an image for this part of the story.")
+                for i, candidate in enumerate(candidates, start=1):
+                    st.markdown(f"**Option {i}:** {candidate}")
+                picked = st.radio("✨ Pick a continuation", range(len(candidates)), format_func=lambda i: f"Option {i + 1}", horizontal=True)
+                if st.button("✅ Use This Continuation"):
+                    add_story_part(candidates[picked])
+                    # Rerun so the story above shows the new part and the options go away
+                    st.session_state.success_message = "Story continued automatically!"
+                    st.rerun()
+
+            # Show the branches side by side; picking one appends it to the story
+            if st.session_state.branches:
+                branch_cols = st.columns(len(st.session_state.branches))
+                for i, (branch_col, branch) in enumerate(zip(branch_cols, st.session_state.branches), start=1):
+                    with branch_col:
+                        st.markdown(branch)
+                        if st.button(f"Use Branch {i}"):
+                            add_story_part(branch)
+                            st.session_state.success_message = "Story continued!"
+                            st.rerun()
+
         if st.session_state.stopped:
-            st.subheader("📤 Export Your Story")
-            
-            if st.button("🖨️ Convert to PDF"):
-                pdf = convert_to_pdf(st.session_state.story)
-                pdf_output = pdf.output(dest='S').encode('latin1')
-                b64_pdf = base64.b64encode(pdf_output).decode('latin1')
-                href = f'<a href="data:application/octet-stream;base64,{b64_pdf}" download="story.pdf">Download PDF</a>'
-                st.markdown(href, unsafe_allow_html=True)
-
-            language_option = st.selectbox("🌍 Choose a language for the audio:", ["English", "Spanish", "French", "Chinese"])
-            lang_dict = {"English": "en", "Spanish": "es", "French": "fr", "Chinese": "zh"}
-
-            if st.button("🎧 Convert to Audio"):
-                selected_lang = lang_dict[language_option]
-                audio_file = convert_to_audio(" ".join(st.session_state.story), language=selected_lang)
-                with open(audio_file, "rb") as audio:
-                    b64_audio = base64.b64encode(audio.read()).decode('latin1')
-                href = f'<a href="data:audio/mp3;base64,{b64_audio}" download="story_audio.mp3">Download Audio</a>'
-                st.markdown(href, unsafe_allow_html=True)
+            show_export_options()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
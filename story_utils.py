@@ -0,0 +1,395 @@
+import asyncio
+import streamlit as st
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAIError
+import io
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Helpers shared by app.py and app2.py: the OpenAI client and event loop, the running
+# summary of the story, and the PDF and audio exports
+
+# Languages offered for the audio export, mapped to their gTTS codes
+LANGUAGES = {"English": "en", "Spanish": "es", "French": "fr", "Chinese": "zh"}
+LANGUAGE_OPTIONS = list(LANGUAGES)
+
+# Directory where synthesized audio is cached between runs
+TTS_CACHE_DIR = Path(tempfile.gettempdir()) / "story_tts_cache"
+TTS_CACHE_MAX_BYTES = 100 * 1024 * 1024
+# Number of story parts synthesized at the same time
+TTS_WORKERS = 4
+
+# Unicode fonts looked for in the usual Linux, macOS and Windows locations; the first one
+# installed is used for PDFs. PDF_FONT_FILE picks another font. Without any of them the
+# text is cleaned for the core fonts
+WINDOWS_FONT_DIR = os.path.join(os.environ.get("WINDIR", "C:\\Windows"), "Fonts")
+PDF_FONT_FILES = [
+    os.environ.get("PDF_FONT_FILE", ""),
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu-sans-fonts/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSans-Regular.ttf",
+    "/usr/share/fonts/noto/NotoSans-Regular.ttf",
+    "/System/Library/Fonts/Supplemental/Arial Unicode.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    os.path.join(WINDOWS_FONT_DIR, "arial.ttf"),
+]
+
+# Fonts for the characters the main font lacks, such as Chinese, which the Latin fonts
+# above do not cover. PDF_FALLBACK_FONT_FILE picks another font
+PDF_FALLBACK_FONT_FILES = [
+    os.environ.get("PDF_FALLBACK_FONT_FILE", ""),
+    "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+    "/usr/share/fonts/google-droid-sans-fonts/DroidSansFallbackFull.ttf",
+    "/System/Library/Fonts/Supplemental/Arial Unicode.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    os.path.join(WINDOWS_FONT_DIR, "simhei.ttf"),
+]
+
+# Number of rendered PDFs and audio exports kept in memory; audio exports are large and
+# cheap to rebuild from the on-disk per-part cache, so they also expire after an hour
+PDF_CACHE_SIZE = 16
+AUDIO_CACHE_SIZE = 32
+AUDIO_CACHE_TTL = 3600
+
+# Typographic characters the core PDF fonts cannot encode, mapped to plain equivalents
+PDF_CHAR_MAP = str.maketrans({"‘": "'", "’": "'", "“": '"', "”": '"', "–": "-", "—": "-", "•": "-", "…": "..."})
+
+# Chat models per task: summaries are short and templated, so they go to the smaller, faster model
+STORY_MODEL = "gpt-3.5-turbo"
+SUMMARY_MODEL = "gpt-4o-mini"
+
+# Amount of recent story text sent verbatim with every prompt; older text is folded
+# into the running summary as it leaves this window
+RECENT_CONTEXT_CHARS = 2000
+
+# Token budget of the running summary
+SUMMARY_TOKENS = 300
+
+# Number of summaries kept per session
+SUMMARY_CACHE_SIZE = 32
+
+# Number of alternatives offered by "Continue Automatically"
+AUTO_CONTINUATIONS = 3
+
+# Temperatures of the branches explored side by side, from safest to most surprising
+BRANCH_TEMPERATURES = (0.4, 0.7, 1.0)
+
+# Seconds an idle pooled connection is kept. httpx's default of 5 s expires before the
+# user has read the last part and typed a choice; this outlasts a turn while staying under
+# the API's own idle timeout. A connection the server dropped anyway is retried by the client
+CLIENT_KEEPALIVE_SECONDS = 120
+
+# Function to set the OpenAI API key, returning the session's client or None until a key is entered
+def set_openai_key():
+    st.sidebar.write("🔑 **Enter your OpenAI API Key**")
+    api_key = st.sidebar.text_input("API Key", type="password")
+    if not api_key:
+        # A cleared key takes the page back to asking for one, instead of leaving the
+        # buttons wired to a missing client
+        st.session_state.pop("api_key", None)
+        return None
+    st.session_state.api_key = api_key
+    st.sidebar.success("API Key set successfully!")
+    return get_client(api_key)
+
+# Function to get the session's OpenAI client, created once per API key so that its
+# pooled connections are kept alive between turns. HTTP/2 lets the concurrent story,
+# summary and image requests share a single connection and TLS handshake, and the idle
+# connection is kept for CLIENT_KEEPALIVE_SECONDS so the next turn can reuse it
+def get_client(api_key):
+    if st.session_state.get("client_api_key") != api_key:
+        if "client" in st.session_state:
+            # Release the old key's pooled connections on the loop that opened them
+            run_async(st.session_state.client.close())
+        st.session_state.client = AsyncOpenAI(
+            api_key=api_key,
+            max_retries=2,
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                timeout=httpx.Timeout(60.0, connect=5.0),
+                limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=CLIENT_KEEPALIVE_SECONDS),
+            ),
+        )
+        st.session_state.client_api_key = api_key
+    return st.session_state.client
+
+# Function to run a coroutine to completion from the Streamlit script. The session keeps
+# one event loop because the client's connections are bound to the loop that opened them.
+def run_async(coro):
+    if "event_loop" not in st.session_state:
+        st.session_state.event_loop = asyncio.new_event_loop()
+    loop = st.session_state.event_loop
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        # A failure or a rerun can leave tasks of this run pending. Cancel them so they do not
+        # resume and write to the session state in the middle of a later run. Summary requests
+        # stay, since the summary cache shares them with later callers
+        summary_tasks = set(st.session_state.get("summary_cache", {}).values())
+        pending = [task for task in asyncio.all_tasks(loop) if task not in summary_tasks]
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+# Function to build the cache key of several values in a single hashing pass, used by
+# the summary and audio caches
+def fingerprint(*parts):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+# Function to generate one or more alternative story parts from the chat messages
+async def generate_stories(client, messages, n=1, temperature=0.7):
+    response = await client.chat.completions.create(
+        model=STORY_MODEL,
+        messages=messages,
+        max_tokens=900,
+        temperature=temperature,
+        n=n,
+    )
+
+    # One story per requested alternative
+    stories = [c.message.content.strip() for c in response.choices]
+    return stories
+
+# Function to stream a single story part into a placeholder as the tokens arrive
+async def stream_story_text(client, messages, text_slot, temperature=0.7):
+    response = await client.chat.completions.create(
+        model=STORY_MODEL,
+        messages=messages,
+        max_tokens=900,
+        temperature=temperature,
+        stream=True,
+    )
+
+    chunks = []
+    async for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            chunks.append(chunk.choices[0].delta.content)
+            text_slot.markdown("".join(chunks))
+    return "".join(chunks).strip()
+
+# Function to summarize the prompt to reduce token count
+async def summarize_text(client, text, max_tokens=SUMMARY_TOKENS):
+    # Reuse the summary when the same text was already summarized in this session,
+    # e.g. when a turn interrupted by a rerun or a failed request is tried again.
+    # The cache holds the request itself, so a caller asking while it is still in flight shares it
+    if "summary_cache" not in st.session_state:
+        st.session_state.summary_cache = OrderedDict()
+    summary_cache = st.session_state.summary_cache
+    key = fingerprint(max_tokens, text)
+    task = summary_cache.get(key)
+    if task is None:
+        task = asyncio.create_task(request_summary(client, text, max_tokens))
+        summary_cache[key] = task
+        if len(summary_cache) > SUMMARY_CACHE_SIZE:
+            summary_cache.popitem(last=False)
+    else:
+        summary_cache.move_to_end(key)
+
+    try:
+        # Shielded so that one caller giving up does not cancel the request for the others
+        return await asyncio.shield(task)
+    except Exception:
+        # Forget a failed request so the next call tries again
+        if summary_cache.get(key) is task:
+            del summary_cache[key]
+        raise
+
+# Function to ask the model for a summary of the text
+async def request_summary(client, text, max_tokens):
+    summarization_prompt = f"Please summarize the following text to stay under {max_tokens} tokens while maintaining its main idea:\n\n{text}"
+
+    response = await client.chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": summarization_prompt}
+        ],
+        max_tokens=max_tokens,
+        temperature=0.7,
+    )
+
+    summarized_text = response.choices[0].message.content.strip()
+    return summarized_text
+
+# Function to start the story state the first time the page runs in a session
+def init_story_state():
+    if "story" not in st.session_state:
+        reset_story()
+        st.session_state.started = False
+
+# Function to start the story over from a base idea
+def reset_story(base_story=""):
+    st.session_state.story = [base_story] if base_story else []
+    st.session_state.story_text = base_story
+    st.session_state.running_summary = ""
+    st.session_state.summarized_chars = 0
+    st.session_state.candidates = []
+    st.session_state.branches = []
+    st.session_state.started = True
+    st.session_state.stopped = False
+
+# Function to build the prompt context from the running summary and the text it does not
+# cover yet, so the prompt stays bounded however long the story gets without losing any part
+def get_story_context():
+    recent_text = st.session_state.story_text[st.session_state.summarized_chars:]
+    if st.session_state.running_summary:
+        return f"{st.session_state.running_summary}\n\n[Recent:] {recent_text}"
+    return recent_text
+
+# Function to fold the text leaving the recent window into the running summary once the
+# unsummarized text outgrows the window; it runs alongside the next story request and is
+# optional, so a failed summary never fails the turn
+async def update_running_summary(client):
+    story_text = st.session_state.story_text
+    summarized_chars = st.session_state.summarized_chars
+    if len(story_text) - summarized_chars <= RECENT_CONTEXT_CHARS:
+        return
+    # Only the text before the window is summarized, cut at a word boundary when there is one
+    cut = len(story_text) - RECENT_CONTEXT_CHARS
+    space = story_text.rfind(" ", summarized_chars, cut)
+    if space > summarized_chars:
+        cut = space
+    old_text = story_text[summarized_chars:cut]
+    try:
+        running_summary = await summarize_text(client, f"{st.session_state.running_summary}\n\n{old_text}")
+    except OpenAIError:
+        # Keep the old summary; the same text is still unsummarized, so the next turn retries
+        return
+    st.session_state.running_summary = running_summary
+    st.session_state.summarized_chars = cut
+
+# Function to append a new part to the story, keeping the joined story text in sync
+def add_story_part(part):
+    st.session_state.story.append(part)
+    st.session_state.story_text += " " + part
+    st.session_state.candidates = []
+    st.session_state.branches = []
+
+# Function to show the PDF and audio downloads of the finished story
+def show_export_options():
+    st.subheader("📤 Export Your Story")
+
+    # The files are only built when their button is clicked, on a separate thread from
+    # the page script, and are served straight from the conversion without an extra click
+    st.download_button("🖨️ Convert to PDF", data=partial(convert_to_pdf, st.session_state.story), file_name="story.pdf", mime="application/pdf")
+
+    language_option = st.selectbox("🌍 Choose a language for the audio:", LANGUAGE_OPTIONS)
+
+    selected_lang = LANGUAGES[language_option]
+    st.download_button("🎧 Convert to Audio", data=partial(convert_to_audio, st.session_state.story, language=selected_lang), file_name="story_audio.mp3", mime="audio/mpeg")
+
+# Function to convert story to PDF
+@st.cache_data(show_spinner=False, max_entries=PDF_CACHE_SIZE)
+def convert_to_pdf(story_parts):
+    from fpdf import FPDF, XPos, YPos
+
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_auto_page_break(auto=True, margin=15)
+
+    font_file = find_font(PDF_FONT_FILES + PDF_FALLBACK_FONT_FILES)
+    unicode_font = font_file is not None
+    if unicode_font:
+        pdf.add_font("Story", "", font_file)
+        # Characters missing from the main font are taken from the fallback font
+        fallback_font_file = find_font(PDF_FALLBACK_FONT_FILES)
+        if fallback_font_file not in (None, font_file):
+            pdf.add_font("StoryFallback", "", fallback_font_file)
+            pdf.set_fallback_fonts(["StoryFallback"])
+        pdf.set_font("Story", size=12)
+    else:
+        pdf.set_font("Helvetica", size=12)
+
+    # One layout pass for the whole story; each part still starts on a new line
+    text = "\n".join(story_parts)
+    if not unicode_font:
+        text = clean_text_for_pdf(text)
+    pdf.multi_cell(0, 10, text, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    return bytes(pdf.output())
+
+# Function to find the first of the font files that is installed
+def find_font(font_files):
+    return next((font_file for font_file in font_files if font_file and os.path.isfile(font_file)), None)
+
+# Function to make text safe for the latin-1 core fonts. Both passes run in C: the
+# translate table, then the latin-1 codec replacing whatever is left with "?"
+def clean_text_for_pdf(text):
+    return text.translate(PDF_CHAR_MAP).encode("latin-1", "replace").decode("latin-1")
+
+# Function to convert story to audio
+@st.cache_data(show_spinner=False, max_entries=AUDIO_CACHE_SIZE, ttl=AUDIO_CACHE_TTL)
+def convert_to_audio(story_parts, language='en'):
+    TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Each part is synthesized and cached on its own, so a story that only grew by
+    # one part needs a single new gTTS request. MP3 frames can be joined as-is.
+    # gTTS blocks on the network, so the missing parts are fetched side by side;
+    # map keeps them in story order.
+    parts = [part for part in story_parts if part.strip()]
+    with ThreadPoolExecutor(max_workers=TTS_WORKERS) as executor:
+        audio = b"".join(executor.map(get_part_audio, parts, [language] * len(parts)))
+
+    evict_tts_cache()
+    return audio
+
+# Function to get the audio of one story part from the cache, synthesizing it if needed
+def get_part_audio(text, language):
+    # Reuse the cached file when this text was already synthesized in this language
+    key = fingerprint(language, text)
+    audio_file = TTS_CACHE_DIR / f"{key}.mp3"
+    try:
+        os.utime(audio_file)
+        return audio_file.read_bytes()
+    except FileNotFoundError:
+        # Not cached yet, or evicted by another export in the meantime
+        pass
+
+    # Synthesize in memory; the cache file is only written from these bytes
+    from gtts import gTTS
+    buffer = io.BytesIO()
+    gTTS(text=text, lang=language, slow=False).write_to_fp(buffer)
+    audio = buffer.getvalue()
+
+    # Write to a temporary file first so a half-written file is never served
+    fd, tmp_file = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(audio)
+        os.replace(tmp_file, audio_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return audio
+
+# Function to keep the audio cache under its size limit, removing the least recently used files first
+def evict_tts_cache():
+    # Each file is stat'ed once; another export may evict files while this one runs, so a
+    # file that is already gone is skipped
+    files = []
+    for f in TTS_CACHE_DIR.glob("*.mp3"):
+        try:
+            stat = f.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, f))
+    files.sort(key=lambda entry: entry[0])
+
+    total_size = sum(size for _, size, _ in files)
+    for _, size, f in files:
+        if total_size <= TTS_CACHE_MAX_BYTES:
+            break
+        total_size -= size
+        f.unlink(missing_ok=True)